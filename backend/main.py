@@ -1,15 +1,40 @@
 import sqlite3
 import uvicorn
 import os
-from fastapi import FastAPI
+import functools
+import orjson
+import pathlib
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional, List, Tuple
+from typing import Optional
 
 BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(BACKEND_DIR)
 DB_PATH = os.path.join(PROJECT_ROOT, "data", "genomics_subset.db")
+INDEX_DIR = os.path.join(PROJECT_ROOT, "data", "genomics_subset.index") # Column files derived from the database
+MANIFEST_PATH = os.path.join(INDEX_DIR, "index.json")
+INDEX_VERSION = 2 # Bumped whenever the layout of the index files changes, forcing a rebuild
+LONG_INTERVAL_BP = 1 << 20 # Intervals longer than this are kept apart so they don't widen the binary search
+CACHE_BYTES = 64 << 20 # Total size of the response payloads each worker keeps cached
+CACHE_ENTRY_BYTES = 1 << 20 # Payloads larger than this are never cached, so one huge query cannot flush the cache
+MMAP_SIZE = 1 << 30 # Bytes of the database SQLite reads through mmap, shared across workers via the page cache
 
-app = FastAPI(title="Genomic Region Overlap Engine")
+"""Normalizes a chromosome name so 'chr1', 'Chr1' and '1' all become '1', matching how the indexer stores them."""
+def normalize_chrom(chrom: str) -> str:
+    chrom = chrom.strip().lower()
+    return chrom[3:] if chrom.startswith("chr") else chrom
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the interval index before serving, rather than on the first request
+    get_index()
+    yield
+
+app = FastAPI(title="Genomic Region Overlap Engine", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,102 +43,245 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-"""Calculates the total unique base pairs covered by a list of intervals to prevent overcounting"""
-def merge_and_sum(intersections: List[Tuple[int, int]]) -> int:
-    if not intersections:
-        return 0
+"""Calculates the total unique base pairs covered by each track's intervals to prevent overcounting.
+Expects the intervals to be sorted by track group, then by start coordinate."""
+def merge_and_sum(starts: np.ndarray, ends: np.ndarray, groups: np.ndarray, n_groups: int) -> np.ndarray:
+    if len(starts) == 0:
+        return np.zeros(n_groups, dtype=np.int64)
     
-    # Sort by start coordinate
-    intersections.sort(key=lambda x: x[0])
+    # Shift every group onto its own stretch of the number line so blocks never span two tracks
+    offset = groups * (int(ends.max()) + 1)
+    starts, ends = starts + offset, ends + offset
     
-    total_bp = 0
-    curr_start, curr_end = intersections[0]
+    # Furthest end reached so far; an interval starting at or past it opens a new block
+    reach = np.maximum.accumulate(ends)
+    breaks = np.flatnonzero(starts[1:] >= reach[:-1]) + 1
     
-    for next_start, next_end in intersections[1:]:
-        if next_start < curr_end:
-            # Overlap found: extend the current boundary
-            curr_end = max(curr_end, next_end)
-        else:
-            # No overlap: add the previous block and reset
-            total_bp += (curr_end - curr_start)
-            curr_start, curr_end = next_start, next_end
-            
-    # Add the final block
-    total_bp += (curr_end - curr_start)
-    return total_bp
+    block_first = np.concatenate(([0], breaks))
+    block_last = np.concatenate((breaks - 1, [len(starts) - 1]))
+    block_bp = reach[block_last] - starts[block_first]
+    return np.bincount(groups[block_first], weights=block_bp, minlength=n_groups).astype(np.int64)
 
 def get_db():
     if not os.path.exists(DB_PATH):
         raise FileNotFoundError(f"Database not found at {DB_PATH}. Did you run indexer.py?")
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    # The backend never writes, so open read-only and let SQLite map pages instead of copying them
+    conn = sqlite3.connect(f"{pathlib.Path(DB_PATH).as_uri()}?mode=ro", uri=True)
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
     return conn
 
-@app.get("/api/overlaps")
-async def find_overlaps(
-    chr: str, start: int, end: int, 
-    tissue: Optional[str] = "All", 
-    maxTracks: int = 50
-):
+"""Writes a file through a temporary file in the same directory, then swaps it into place.
+The temporary file is removed if writing fails."""
+def write_atomically(path, write):
+    # NamedTemporaryFile creates files as 0600; give the result the permissions any new file would get
+    umask = os.umask(0)
+    os.umask(umask)
+
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False)
+    try:
+        with f:
+            write(f)
+        os.chmod(f.name, 0o666 & ~umask)
+        os.replace(f.name, path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+"""Materializes the database as flat column files: interval starts, ends and track numbers grouped by chromosome,
+plus a small JSON manifest with per-chromosome offsets and the track metadata. Within each chromosome the
+short intervals come first, sorted by start, followed by the few intervals longer than LONG_INTERVAL_BP."""
+def write_index_files():
     db = get_db()
-    cursor = db.cursor()
+    track_rows = db.execute("""
+    SELECT track_id, track_name, assay, tissue, cell_type, source
+    FROM metadata GROUP BY track_id
+    """).fetchall()
+    rows = db.execute("""
+    SELECT m.track_id, m.chrom, idx.start, idx.end
+    FROM metadata m
+    JOIN idx_intervals idx ON idx.id = m.id
+    """).fetchall()
+    db.close()
+
+    track_ids, chroms, starts, ends = zip(*rows) if rows else ((), (), (), ())
+
+    # Tracks and chromosomes are numbered by their position in sorted order. Chromosome names are
+    # normalized once per distinct raw name, so databases built before normalization still match.
+    track_names, track_codes = np.unique(np.array(track_ids, dtype=str), return_inverse=True)
+    raw_chroms, raw_codes = np.unique(np.array(chroms, dtype=str), return_inverse=True)
+    chrom_names, chrom_remap = np.unique(np.array([normalize_chrom(c) for c in raw_chroms.tolist()], dtype=str),
+                                         return_inverse=True)
+    chrom_codes = chrom_remap[raw_codes]
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+
+    is_long = (ends - starts) > LONG_INTERVAL_BP
+    order = np.lexsort((starts, is_long, chrom_codes))
+    columns = {
+        "starts": starts[order],
+        "ends": ends[order],
+        "tracks": track_codes[order].astype(np.int32)
+    }
+    counts = np.bincount(chrom_codes, minlength=len(chrom_names))
+    chrom_end = np.cumsum(counts)
+    chrom_start = chrom_end - counts
+
+    long_counts = np.bincount(chrom_codes[is_long], minlength=len(chrom_names))
+
+    # max_len only covers the short intervals, which keeps the search window around a query tight
+    chrom_offsets = {}
+    for chrom, lo, hi, n_long in zip(chrom_names.tolist(), chrom_start.tolist(), chrom_end.tolist(), long_counts.tolist()):
+        mid = hi - n_long
+        max_len = int((columns["ends"][lo:mid] - columns["starts"][lo:mid]).max(initial=0))
+        chrom_offsets[chrom] = [lo, mid, hi, max_len]
+
+    track_metadata = {r[0]: list(r) for r in track_rows}
+
+    # Each file is written under a temporary name private to this process and swapped in whole, manifest last.
+    # Workers that rebuild concurrently on a cold start therefore never write into or expose each other's files.
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    for name, column in columns.items():
+        write_atomically(os.path.join(INDEX_DIR, f"{name}.npy"), lambda f: np.save(f, column))
+
+    manifest = orjson.dumps({
+        "version": INDEX_VERSION,
+        "chroms": chrom_offsets,
+        "tracks": [track_metadata[tid] for tid in track_names.tolist()]
+    })
+    write_atomically(MANIFEST_PATH, lambda f: f.write(manifest))
+
+"""Reads the index manifest, or returns None when it is missing, older than the database or from another layout."""
+def read_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return None
+    if os.path.exists(DB_PATH) and os.path.getmtime(MANIFEST_PATH) < os.path.getmtime(DB_PATH):
+        return None
+    with open(MANIFEST_PATH, "rb") as f:
+        manifest = orjson.loads(f.read())
+    return manifest if manifest.get("version") == INDEX_VERSION else None
+
+"""Loads the interval index, memory-mapping its column files so the pages are shared by every worker process.
+The files are (re)built from the database when missing or stale."""
+@functools.cache
+def get_index():
+    manifest = read_manifest()
+    if manifest is None:
+        write_index_files()
+        manifest = read_manifest()
+    starts, ends, tracks = (np.load(os.path.join(INDEX_DIR, f"{name}.npy"), mmap_mode="r")
+                            for name in ("starts", "ends", "tracks"))
+
+    by_chrom = {
+        chrom: (starts[lo:hi], ends[lo:hi], tracks[lo:hi], mid - lo, max_len)
+        for chrom, (lo, mid, hi, max_len) in manifest["chroms"].items()
+    }
+    return {
+        "chroms": by_chrom,
+        "tracks": manifest["tracks"],
+        "tissues": np.array([t[3] for t in manifest["tracks"]], dtype=object)
+    }
+
+"""Computes the ranked overlap results for one query."""
+def compute_overlaps(chr: str, start: int, end: int, tissue: Optional[str], maxTracks: int) -> list:
+    index = get_index()
     query_len = end - start
-    
-    query = """
-    SELECT m.*, idx.start as t_start, idx.end as t_end
-    FROM idx_intervals idx
-    JOIN metadata m ON idx.id = m.id
-    WHERE m.chrom = ? AND idx.start < ? AND idx.end > ?
-    """
-    params = [chr, end, start]
 
-    if tissue and tissue != "All":
-        query += " AND m.tissue = ?"
-        params.append(tissue)
+    if chr not in index["chroms"]:
+        return []
+    starts, ends, tracks, n_short, max_len = index["chroms"][chr]
 
-    cursor.execute(query, params)
-    
-    # Storage for track-wise intersections
-    track_intersections = {} 
-    track_metadata = {}
+    # No short interval is longer than max_len, so only those starting in (start - max_len, end) can reach the window
+    short_starts = starts[:n_short]
+    lo = np.searchsorted(short_starts, start - max_len, side="right")
+    hi = np.searchsorted(short_starts, end, side="left")
+    short_hits = np.flatnonzero(ends[lo:hi] > start) + lo
 
-    for r in cursor:
-        tid = r['track_id']
-        
-        # Calculate the actual intersection with the query window
-        i_start = max(start, r['t_start'])
-        i_end = min(end, r['t_end'])
-        
-        if tid not in track_intersections:
-            track_intersections[tid] = []
-            track_metadata[tid] = {
-                "track_id": tid,
-                "track_name": r['track_name'],
-                "assay": r['assay'],
-                "tissue": r['tissue'],
-                "cell_type": r['cell_type'],
-                "source": r['source']
-            }
-        
-        track_intersections[tid].append((i_start, i_end))
+    # The handful of long intervals are checked in full
+    long_hits = np.flatnonzero((starts[n_short:] < end) & (ends[n_short:] > start)) + n_short
+    hits = np.concatenate((short_hits, long_hits))
 
-    # Calculate final unique coverage for each track
-    final_results = []
-    for tid, intervals in track_intersections.items():
-        # Merge overlaps to avoid double-counting
-        unique_overlap_bp = merge_and_sum(intervals)
-        
-        res = track_metadata[tid]
-        res["overlap_bp"] = unique_overlap_bp
-        res["overlap_pct"] = round((unique_overlap_bp / query_len) * 100, 2)
-        res["hit_count"] = len(intervals)
-        res["target_interval_display"] = "; ".join([f"{int(s)}-{int(e)}" for s, e in intervals])
+    if tissue and tissue != "All":
+        hits = hits[index["tissues"][tracks[hits]] == tissue]
+    if len(hits) == 0:
+        return []
+    
+    # Calculate the actual intersection with the query window
+    i_starts = np.maximum(starts[hits], start)
+    i_ends = np.minimum(ends[hits], end)
+    
+    # Group hits by track, sorted by start coordinate within each track
+    track_codes, group = np.unique(tracks[hits], return_inverse=True)
+    order = np.lexsort((i_starts, group))
+    i_starts, i_ends, group = i_starts[order], i_ends[order], group[order]
+    counts = np.bincount(group)
+    group_end = np.cumsum(counts)
+    group_start = group_end - counts
+    
+    # Merge overlaps to avoid double-counting, for every track at once
+    overlap_bp = merge_and_sum(i_starts, i_ends, group, len(track_codes))
+    
+    # Rank tracks by coverage, breaking ties by track_id (track codes follow sorted track_id order),
+    # so the same query always returns the same tracks. Only the returned ones are built.
+    top = np.lexsort((track_codes, -overlap_bp))[:maxTracks]
+    
+    sorted_results = []
+    for g in top.tolist():
+        tid, track_name, assay, tissue_name, cell_type, source = index["tracks"][track_codes[g]]
+        lo, hi = group_start[g], group_end[g]
+        unique_overlap_bp = int(overlap_bp[g])
         
-        final_results.append(res)
+        sorted_results.append({
+            "track_id": tid,
+            "track_name": track_name,
+            "assay": assay,
+            "tissue": tissue_name,
+            "cell_type": cell_type,
+            "source": source,
+            "overlap_bp": unique_overlap_bp,
+            "overlap_pct": round((unique_overlap_bp / query_len) * 100, 2),
+            "hit_count": int(hi - lo),
+            "target_interval_display": "; ".join([f"{s}-{e}" for s, e in zip(i_starts[lo:hi].tolist(), i_ends[lo:hi].tolist())])
+        })
 
-    sorted_results = sorted(final_results, key=lambda x: x['overlap_bp'], reverse=True)
+    return sorted_results
+
+# Query -> serialized response, least recently used first, bounded by CACHE_BYTES in total
+payload_cache = OrderedDict()
+payload_cache_bytes = 0
+
+"""Serializes the results for one query straight to JSON bytes.
+Identical queries (panning back, shared links) are served from an in-process LRU cache without re-encoding."""
+def overlaps_payload(chr: str, start: int, end: int, tissue: Optional[str], maxTracks: int) -> bytes:
+    global payload_cache_bytes
+    key = (chr, start, end, tissue, maxTracks)
+    payload = payload_cache.get(key)
+    if payload is not None:
+        payload_cache.move_to_end(key)
+        return payload
+
+    results = compute_overlaps(chr, start, end, tissue, maxTracks)
+    payload = orjson.dumps({"results": results})
+
+    if len(payload) <= CACHE_ENTRY_BYTES:
+        payload_cache[key] = payload
+        payload_cache_bytes += len(payload)
+        while payload_cache_bytes > CACHE_BYTES:
+            _, evicted = payload_cache.popitem(last=False)
+            payload_cache_bytes -= len(evicted)
+    return payload
+
+@app.get("/api/overlaps")
+async def find_overlaps(
+    chr: str, start: int, end: int, 
+    tissue: Optional[str] = "All", 
+    maxTracks: int = 50
+):
+    # An empty window has no length to report overlap percentages against
+    if end <= start:
+        raise HTTPException(status_code=422, detail="end must be greater than start")
 
-    return {"results": sorted_results[:maxTracks]}
+    payload = overlaps_payload(normalize_chrom(chr), start, end, tissue, maxTracks)
+    return Response(content=payload, media_type="application/json")
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -1,49 +1,128 @@
 import pandas as pd
 import sqlite3
 import requests
-import gzip
+import io
 import os
+import queue
 import random
+from email.utils import formatdate, parsedate_to_datetime
+from isal import igzip, isal_zlib
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 METADATA_URL = "https://tf.lisanwanglab.org/FILER2/metadata/tracks.metadata.tsv"
 FORMAT_URL = "https://tf.lisanwanglab.org/FILER2/metadata/track.formats.4col.tsv"
 DATA_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_NAME = os.path.join(DATA_DIR, "genomics_subset.db")
+METADATA_CACHE = os.path.join(DATA_DIR, "metadata.parquet") # Merged metadata from the last download
 SUBSET_COUNT = 2500 # Number of tracks we want to sample from
-WORKERS = os.cpu_count() or 4
+# Workers spend much of each track waiting on the network, so run more of them than there are cores
+# (up to 32; machines with more cores than that still get one worker per core)
+CPUS = os.cpu_count() or 4
+WORKERS = max(CPUS, min(32, 2 * CPUS))
+READ_SIZE = 128 * 1024 # Bytes of decompressed data read per chunk
+RAW_BUFFER_SIZE = 1 << 20 # Bytes of compressed data buffered per socket read
+WRITE_BATCH_SIZE = 5000 # Rows buffered by the database writer before each executemany flush
 
-"""Maps FILER_BED_schema to the correct (chrom, start, end) column indices."""
-def get_indices(schema):
-    # Interaction tracks (Hi-C) store the interaction span in columns 5, 6, 7
+# Only the fields process_track needs are sent to the workers, in this order
+TRACK_FIELDS = ['identifier', 'processed_file_download_url', 'FILER_BED_schema', 'track_name',
+                'tissue_category', 'cell_type', 'assay', 'data_source']
+
+# Columns read from the metadata TSVs; everything else in them is never parsed into memory
+METADATA_COLUMNS = ['identifier', 'processed_file_download_url', 'track_name', 'assay',
+                    'tissue_category', 'cell_type', 'data_source', 'file_format']
+FORMAT_COLUMNS = ['FILER_BED_format', 'FILER_BED_schema']
+# Low-cardinality columns, stored as categories instead of one string object per row
+CATEGORY_COLUMNS = ['assay', 'tissue_category', 'data_source', 'file_format']
+
+# Byte translation table that lowercases ASCII letters in a single C-level pass
+CHROM_LOWER = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', b'abcdefghijklmnopqrstuvwxyz')
+
+session = None # Per-process HTTP session, set up by _init_worker (or lazily on first use)
+
+"""Normalizes a raw chromosome field so 'chr1', 'Chr1' and '1' all become b'1'.
+Works on the bytes straight from the line, so no intermediate strings are created."""
+def normalize_chrom(chrom):
+    chrom = chrom.strip().translate(CHROM_LOWER)
+    return chrom[3:] if chrom.startswith(b'chr') else chrom
+
+"""Parses a standard BED line into (chrom, start, end)."""
+def parse_bed3(line):
+    fields = line.split(b'\t', 3)
+    return fields[0], int(fields[1]), int(fields[2])
+
+"""Parses an interaction (Hi-C) line, which stores the interaction span in columns 5, 6, 7."""
+def parse_interact(line):
+    fields = line.split(b'\t', 8)
+    return fields[5], int(fields[6]), int(fields[7])
+
+"""Maps FILER_BED_schema to the parser for its (chrom, start, end) columns.
+Each parser has its column indices written in, so the per-line work needs no lookups."""
+def get_parser(schema):
     if schema == "bed4+19 interact":
-        return 5, 6, 7
+        return parse_interact
     # Standard format
-    return 0, 1, 2
+    return parse_bed3
+
+"""Yields the raw lines of a gzipped stream, decompressing it in READ_SIZE chunks.
+A truncated stream ends the iteration early instead of discarding the lines already decoded."""
+def iter_lines(stream):
+    carry = b""
+    # Buffer the raw stream so the decompressor is fed by a few large socket reads instead of many small ones
+    with igzip.IGzipFile(fileobj=io.BufferedReader(stream, buffer_size=RAW_BUFFER_SIZE)) as f:
+        while True:
+            try:
+                chunk = f.read(READ_SIZE)
+            except (EOFError, isal_zlib.error):
+                # The trailing partial line cannot be trusted, so it is dropped
+                return
+            if not chunk:
+                break
+
+            # The last piece may be a partial line, so keep it for the next chunk
+            lines = (carry + chunk).split(b'\n')
+            carry = lines.pop()
+            yield from lines
 
-def process_track(track_data):
-    url = track_data['processed_file_download_url']
-    schema = track_data.get('FILER_BED_schema', 'bed3')
-    c_idx, s_idx, e_idx = get_indices(schema)
+    if carry:
+        yield carry
+
+"""Gives each worker process one pooled HTTP session, so keep-alive and TLS are reused across its tracks."""
+def _init_worker():
+    global session
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+def process_track(track):
+    tid, url, schema, name, tissue, cell, assay, source = track
+    parse = get_parser(schema)
+
+    # Keeps process_track usable outside the pool, where no initializer has run
+    if session is None:
+        _init_worker()
     
     RESERVOIR_SIZE = 1000 # Max number of rows per file
     reservoir = []
     
     meta = {
-        "tid": track_data['identifier'],
-        "name": str(track_data.get('track_name', 'Unnamed')),
-        "tissue": str(track_data.get('tissue_category', 'Unknown')),
-        "cell": str(track_data.get('cell_type', 'N/A')),
-        "assay": str(track_data.get('assay', 'Unknown')),
-        "source": str(track_data.get('data_source', 'Unknown'))
+        "tid": tid,
+        "name": str(name),
+        "tissue": str(tissue),
+        "cell": str(cell),
+        "assay": str(assay),
+        "source": str(source)
     }
 
     try:
-        r = requests.get(url, stream=True, timeout=10)
-        with gzip.open(r.raw, 'rt') as f:
-            for i, line in enumerate(f):
-                if line.startswith(('#', 'track')): continue
+        # Closing the response hands the connection back as soon as the stream is drained
+        with session.get(url, stream=True, timeout=10) as r:
+            # Lets io.BufferedReader see a drained body as EOF rather than as a closed file
+            r.raw.auto_close = False
+            for i, line in enumerate(iter_lines(r.raw)):
+                if line.startswith((b'#', b'track')): continue
                 
                 # Take random sample of RESERVOIR_SIZE rows
                 if len(reservoir) < RESERVOIR_SIZE:
@@ -53,25 +132,86 @@ def process_track(track_data):
                     if m < RESERVOIR_SIZE:
                         reservoir[m] = line
 
-        # Final Parsing of the randomly selected lines
+        # Final Parsing of the randomly selected lines (only these get decoded)
         intervals = []
         for line in reservoir:
-            fields = line.strip().split('\t')
-            if len(fields) <= max(c_idx, s_idx, e_idx): continue
-            
             try:
+                chrom, t_start, t_end = parse(line)
                 intervals.append({
                     **meta,
-                    "chrom": fields[c_idx],
-                    "start": int(fields[s_idx]),
-                    "end": int(fields[e_idx])
+                    "chrom": normalize_chrom(chrom).decode(),
+                    "start": t_start,
+                    "end": t_end
                 })
-            except ValueError:
+            except (IndexError, ValueError):
+                # Too few columns or non-numeric coordinates
                 continue
         return intervals
     except Exception:
         return []
 
+"""Checks whether a remote file has changed since the given timestamp, with a conditional HEAD request."""
+def is_unchanged(url, since):
+    r = requests.head(url, headers={"If-Modified-Since": formatdate(since, usegmt=True)}, timeout=10)
+    if r.status_code == 304:
+        return True
+    # Some servers ignore the condition, so fall back to comparing Last-Modified ourselves
+    last_modified = r.headers.get("Last-Modified")
+    return r.ok and last_modified is not None and parsedate_to_datetime(last_modified).timestamp() <= since
+
+"""Returns the FILER2 track metadata merged with its formats.
+The merged table is cached as Parquet and only re-downloaded when either TSV changes upstream."""
+def load_metadata():
+    if os.path.exists(METADATA_CACHE):
+        cached_at = os.path.getmtime(METADATA_CACHE)
+        try:
+            unchanged = all(is_unchanged(url, cached_at) for url in (METADATA_URL, FORMAT_URL))
+        except requests.RequestException:
+            # Without a connection the cache is the best copy we have
+            unchanged = True
+        if unchanged:
+            return pd.read_parquet(METADATA_CACHE)
+
+    print("Fetching and Merging FILER2 Metadata...")
+    df_meta = pd.read_csv(METADATA_URL, sep='\t', usecols=METADATA_COLUMNS,
+                          dtype={col: 'category' for col in CATEGORY_COLUMNS})
+    df_formats = pd.read_csv(FORMAT_URL, sep='\t', usecols=FORMAT_COLUMNS)
+    
+    # Merge to ensure we know the schema/format of every track
+    df = df_meta.merge(df_formats, left_on='file_format', right_on='FILER_BED_format', how='left')
+    df.to_parquet(METADATA_CACHE, compression='zstd', index=False)
+    return df
+
+"""Drains sampled tracks from the queue into the database until it receives None.
+Runs on its own thread so collecting worker results never waits on SQLite inserts."""
+def write_rows(conn, pending):
+    c = conn.cursor()
+    meta_rows, interval_rows = [], []
+
+    # Row ids are assigned here so both tables can be filled with executemany
+    next_id = 1
+
+    while True:
+        data = pending.get()
+        if data is not None:
+            for row in data:
+                meta_rows.append((next_id, row['tid'], row['name'], row['chrom'], row['tissue'],
+                                  row['cell'], row['assay'], row['source']))
+                interval_rows.append((next_id, row['start'], row['end']))
+                next_id += 1
+
+        if meta_rows and (data is None or len(meta_rows) >= WRITE_BATCH_SIZE):
+            c.executemany("""INSERT INTO metadata 
+                (id, track_id, track_name, chrom, tissue, cell_type, assay, source) 
+                VALUES (?,?,?,?,?,?,?,?)""", meta_rows)
+            c.executemany("INSERT INTO idx_intervals VALUES (?,?,?)", interval_rows)
+            meta_rows, interval_rows = [], []
+
+        if data is None:
+            break
+
+    conn.commit()
+
 def build_index():
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
@@ -79,8 +219,14 @@ def build_index():
     if os.path.exists(DB_NAME):
         os.remove(DB_NAME)
 
-    conn = sqlite3.connect(DB_NAME)
+    # The connection is handed to the writer thread while tracks are sampled, and back afterwards
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
     c = conn.cursor()
+
+    # The file is rebuilt from scratch on failure, so trade durability for bulk-load speed
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=OFF")
+    c.execute("PRAGMA temp_store=MEMORY")
     
     c.execute("CREATE VIRTUAL TABLE idx_intervals USING rtree(id, start, end)")
     c.execute("""CREATE TABLE metadata (
@@ -89,40 +235,41 @@ def build_index():
     )""")
     conn.commit()
 
-    print("Fetching and Merging FILER2 Metadata...")
-    df_meta = pd.read_csv(METADATA_URL, sep='\t')
-    df_formats = pd.read_csv(FORMAT_URL, sep='\t')
-    
-    # Merge to ensure we know the schema/format of every track
-    df = df_meta.merge(df_formats, left_on='file_format', right_on='FILER_BED_format', how='left')
+    df = load_metadata()
 
     # Take random sample of size SUBSET_COUNT
-    tracks = df.dropna(subset=['processed_file_download_url']).sample(n=SUBSET_COUNT).to_dict('records')
-
-    # Parallelize track sampling across multiple CPU cores and insert results sequentially
-    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
-        futures = {executor.submit(process_track, t): t for t in tracks}
-
-        batch_counter = 0
-
-        with tqdm(total=len(tracks), desc="Sampling Tracks") as pbar:
-            for future in as_completed(futures):
-                data = future.result()
-                if data:
-                    for row in data:
-                        c.execute("""INSERT INTO metadata 
-                            (track_id, track_name, chrom, tissue, cell_type, assay, source) 
-                            VALUES (?,?,?,?,?,?,?)""",
-                            (row['tid'], row['name'], row['chrom'], row['tissue'], 
-                             row['cell'], row['assay'], row['source']))
-                        c.execute("INSERT INTO idx_intervals VALUES (?,?,?)", (c.lastrowid, row['start'], row['end']))
-                    batch_counter += 1
-
-                    if batch_counter >= 100:
-                        batch_counter = 0
-                        conn.commit()
-                pbar.update(1)
-    
+    sample = df.dropna(subset=['processed_file_download_url']).sample(n=SUBSET_COUNT)
+    tracks = list(sample[TRACK_FIELDS].itertuples(index=False, name=None))
+
+    # Parallelize track sampling across worker processes while a single thread streams results into the database
+    pending = queue.Queue()
+    with ThreadPoolExecutor(max_workers=1) as writer_pool:
+        writer = writer_pool.submit(write_rows, conn, pending)
+
+        try:
+            with ProcessPoolExecutor(max_workers=WORKERS, initializer=_init_worker) as executor:
+                futures = {executor.submit(process_track, t): t for t in tracks}
+
+                with tqdm(total=len(tracks), desc="Sampling Tracks") as pbar:
+                    for future in as_completed(futures):
+                        # The writer only finishes early by failing; stop downloading and surface its error below
+                        if writer.done() and writer.exception() is not None:
+                            executor.shutdown(cancel_futures=True)
+                            break
+
+                        data = future.result()
+                        if data:
+                            pending.put(data)
+                        pbar.update(1)
+        finally:
+            # Always release the writer, or an error above would leave the pool waiting on it forever
+            pending.put(None)
+
+        # Surfaces any error raised on the writer thread
+        writer.result()
+
+    # Fold the WAL back in so the database is a single file that read-only clients can open
+    c.execute("PRAGMA journal_mode=DELETE")
     conn.close()
     print(f"Database {DB_NAME} built from {SUBSET_COUNT} tracks.")
 